@@ -3,14 +3,90 @@ from __future__ import print_function
 import argparse
 import csv
 import glob
-import json
 import nixio as nix
 import numpy as np
-import operator
 import os
 import scipy.io as scio
 import sys
 
+try:
+    # considerably faster parsing of the (large) tobii json files
+    import orjson as json
+except ImportError:
+    import json
+
+# number of values per hdf5 chunk of the eeg arrays, each chunk spans a window of time
+# across all channels
+CHUNK_VALUES = 2**16
+
+
+def mean_interval(first, last, nsamples):
+    """
+    mean sampling interval of monotonic timestamps, equals np.mean(np.diff(time))
+    :param first: first timestamp
+    :param last: last timestamp
+    :param nsamples: number of timestamps
+    :return: mean distance between two samples
+    """
+    return (last - first) / (nsamples - 1)
+
+
+def sampling_interval(time):
+    """
+    mean sampling interval of a monotonic time vector without building np.diff(time)
+    :param time: time vector
+    :return: mean distance between two samples
+    """
+    return mean_interval(time[0], time[-1], time.size)
+
+
+def trigger_transitions(trigger):
+    """
+    finds the samples after which the trigger signal changes its state
+    :param trigger: trigger signal
+    :return: indices of the transitions, states the trigger switches to
+    """
+    indices = np.flatnonzero(np.diff(trigger))
+    return indices, trigger[1:][indices]
+
+
+def rising_edge(trigger, lo=1, hi=5, k=3):
+    """
+    finds the k-th (counting from 0) step of the trigger signal with lo < step < hi
+    :param trigger: trigger signal
+    :return: index of the sample before the step, -1 if there are not enough steps
+    """
+    d = np.diff(trigger)
+    edges = np.flatnonzero((d > lo) & (d < hi))
+    if len(edges) <= k:
+        return -1
+    return edges[k]
+
+
+def create_time_chunked_data_array(block, name, array_type, dtype, shape):
+    """
+    creates an empty data array whose dataset is chunked in windows of time (first dimension)
+    covering all other dimensions, nixio itself leaves the chunk shape to h5py
+    :param shape: shape of the data, time first
+    :return: the data array
+    """
+    da = block.create_data_array(name, array_type, dtype=dtype, shape=shape)
+    try:
+        h5group = da._h5group.group
+        ds = h5group["data"]
+    except (AttributeError, KeyError):
+        return da
+
+    row = tuple(max(1, n) for n in shape[1:])
+    rows = max(1, min(shape[0], CHUNK_VALUES // int(np.prod(row))))
+    kwargs = dict(shape=ds.shape, dtype=ds.dtype, maxshape=ds.maxshape, chunks=(rows,) + row)
+    if ds.compression is not None:
+        kwargs.update(compression=ds.compression, compression_opts=ds.compression_opts)
+    # the dataset is still empty, so replacing it costs nothing
+    del h5group["data"]
+    h5group.create_dataset("data", **kwargs)
+    return da
+
 
 def write_eeg_hardware_metadata(block, group):
     src = block.create_source("eeg setup", "eeg.channel_group")
@@ -32,33 +108,27 @@ def write_session_metadata(nixfile, block, metadatafile):
     # rec_sec["experimenter"] = "John Doe"
     # rec_sec["startDate"] = "-".join([block.name[:4], block.name[4:6], block.name[6:8]])
     block.metadata = md_sec
-    msecs = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    msecs[0] = md_sec
-
-    if sys.version_info[0] < 3:
-        mdf = open(metadatafile, 'rb')
-    else:
-        mdf = open(metadatafile)
-
-    prevcnt = 0
-    for mdatrow in csv.reader(mdf):
-        # print("---{0}".format(mdatrow))
-        for (cnt, mdat) in enumerate(mdatrow):
-            if mdat != '':
-                # print("***{0}".format(mdat))
-                if cnt > prevcnt + 1:
-                    break
-                
-                if len(mdatrow) > cnt + 1:
-                    # print("{0}".format(len(mdatrow)))
-                    # print("{0} {1} {2}".format(cnt, mdatrow, mdat))
-                    msecs[cnt][mdat] = mdatrow[cnt + 1]
-                    break
-                else:
-                    msecs[cnt][mdat] = nix.S(mdat)
-                    msecs[cnt + 1] = msecs[cnt][mdat]
-                    prevcnt = cnt
-                    break
+    # currently open sections, entries starting in column n go into secs[n]
+    secs = [md_sec]
+
+    with open(metadatafile, newline='') as mdf:
+        for mdatrow in csv.reader(mdf):
+            # only the first non empty cell (and the cell after it) of a row is used
+            entry = next(((cnt, mdat) for (cnt, mdat) in enumerate(mdatrow) if mdat), None)
+            if entry is None:
+                continue
+            cnt, mdat = entry
+            if cnt >= len(secs):
+                # nested deeper than the current section allows
+                continue
+
+            if len(mdatrow) > cnt + 1:
+                secs[cnt][mdat] = mdatrow[cnt + 1]
+            else:
+                secs[cnt][mdat] = nix.S(mdat)
+                # leave the deeper sections and enter the new one
+                del secs[cnt + 1:]
+                secs.append(secs[cnt][mdat])
 
 
 def write_subject_metadata(recording_session, name, species="homo sapiens"):
@@ -68,12 +138,12 @@ def write_subject_metadata(recording_session, name, species="homo sapiens"):
     recording_session["subject"]["age"] = 54
 
 
-def write_channel_data(block, data, time, sr, offset):
+def write_channel_data(block, data, time, dt, sr, offset):
     group = block.create_group("eeg data", "nix.eeg.channels")
     hw = write_eeg_hardware_metadata(block, group)
 
-    dt = np.mean(np.diff(time))
-    diff = 1./dt - sr
+    # the timestamps may deviate from the sampling rate in either direction
+    diff = abs(1./dt - sr)
     use_range = diff > np.finfo(np.float32).eps
 
     if use_range:
@@ -81,33 +151,46 @@ def write_channel_data(block, data, time, sr, offset):
               file=sys.stderr)
 
     nchan = data.shape[0]
+    labels = ["channel %d" % (ch + 1) for ch in range(nchan)]
+
+    # all channels go into one data array, time first like the tobii data. The
+    # chunks span windows of time across all channels to match the time window
+    # reads done through the (multi) tags
+    # the amplifier exports single precision samples, store them at half the size
+    # of doubles whenever that is lossless (cast while transposing, no double copy)
+    chdata = np.empty(data.shape[::-1], dtype=np.float32)
+    chdata[...] = data.T
+    if not np.array_equal(chdata, data.T, equal_nan=True):
+        chdata = np.ascontiguousarray(data.T, dtype=np.double)
+
+    da = create_time_chunked_data_array(block, "eeg channels", "nix.eeg.channeldata", chdata.dtype, chdata.shape)
+    da.write_direct(chdata)
+    da.unit = "uV"
+    da.label = "voltage"
+    da.description = "The time dimension has been modified by -" + str(offset)
+
+    if use_range:
+        dim = da.append_range_dimension(time)
+    else:
+        dim = da.append_sampled_dimension(dt)
+    dim.unit = "s"
+    dim.label = "time"
+
+    dim = da.append_set_dimension()
+    dim.labels = labels
 
     for ch in range(nchan):
-        chdata = data[ch, :]
-        da = block.create_data_array("channel %d" % (ch + 1), "nix.eeg.channeldata",
-                                     data=chdata.astype(np.double))
-        da.unit = "uV"
-        da.label = "voltage"
-        da.description = "Time"
-        da.description = "The time dimension has been modified by -" + str(offset)
-
-        if use_range:
-            dim = da.append_range_dimension(time)
-        else:
-            dim = da.append_sampled_dimension(dt)
-        dim.unit = "s"
-        dim.label = "time"
-        sec = write_channel_metadata(hw, "channel %d" % (ch + 1), 100+ch)
-        da.metadata = sec
-        group.data_arrays.append(da)
+        write_channel_metadata(hw, labels[ch], 100+ch)
+    da.metadata = hw
+    group.data_arrays.append(da)
 
     return group
 
 
-def save_events(block, trigger, group_eeg, group_tobii):
-    states = trigger[np.nonzero(np.diff(trigger))]
-    indices = np.nonzero(np.diff(trigger))
-    times = indices[0].astype(np.double) / 512
+def save_events(block, trigger, sr, group_eeg, group_tobii):
+    indices, states = trigger_transitions(trigger)
+    # time of the first sample in the new state
+    times = (indices + 1).astype(np.double) / sr
     corners = times[(states == 8) | (states == 10)]
     exp_start = times[(states == 4) | (states == 6)]
     if len(exp_start) < 1:
@@ -147,14 +230,23 @@ def save_events(block, trigger, group_eeg, group_tobii):
         corner_events.references.append(da)
 
 
-def write_trigger_signal(block, trigger, time, da_group, offset):
-    trigger_da = block.create_data_array("trigger signal", "nix.eeg.trigger",
-                                         data=trigger.astype(np.double))
-    trigger_da.label = "voltage"
-    trigger_da.unit = "mV"
+def write_trigger_signal(block, trigger, time, dt, da_group, offset):
+    # the trigger usually carries small integer state codes, store those as such
+    # and keep anything else as a voltage
+    trigger_codes = trigger.astype(np.int16)
+    is_code = np.array_equal(trigger_codes, trigger)
+    trigger = trigger_codes if is_code else trigger.astype(np.double)
+    trigger_da = create_time_chunked_data_array(block, "trigger signal", "nix.eeg.trigger", trigger.dtype,
+                                                trigger.shape)
+    trigger_da.write_direct(trigger)
+    if is_code:
+        trigger_da.label = "trigger code"
+    else:
+        trigger_da.label = "voltage"
+        trigger_da.unit = "mV"
     trigger_da.description = "The time dimension has been modified by -" + str(offset)
 
-    dim = trigger_da.append_sampled_dimension(np.mean(np.diff(time)))
+    dim = trigger_da.append_sampled_dimension(dt)
     dim.unit = "s"
     dim.label = "time"
 
@@ -177,80 +269,143 @@ def determine_offsets(time, trigger, tobii_data):
     :param tobii_data: json fromatted signal form the tobii
     :return:
     '''
-    trigger_on_erg = np.logical_and(np.diff(trigger) > 1, np.diff(trigger) < 5)
-    sync_trigger_tobii = filter(lambda y: y["dir"] == "out", filter(lambda x: x.__contains__("dir"), tobii_data))
-    sync_trigger_eeg = time[np.where(trigger_on_erg)[0][3]]
+    sync_index = rising_edge(trigger)
+    if sync_index < 0:
+        raise ValueError("could not find the sync pulse in the eeg trigger signal")
+    sync_trigger_eeg = time[sync_index]
+    # stops at the first outgoing sync port signal instead of filtering the whole tobii data
+    sync_trigger_tobii = next((e["ts"] for e in tobii_data if "dir" in e and e["dir"] == "out"), None)
+    if sync_trigger_tobii is None:
+        raise ValueError("could not find an outgoing sync signal in the tobii data")
     # sync pulse must comes 10s after first pulse
-    return sync_trigger_eeg, sync_trigger_tobii[0]+10*10**6
+    return sync_trigger_eeg, sync_trigger_tobii + 10*10**6
 
 
 
 def convert(time, trigger, data, parts, sr, tobii_data, metadatafile, eeg_offset, tobii_offset):
-    f = nix.File.open(parts[0] + ".nix", nix.FileMode.Overwrite)
+    # eeg, trigger and tobii signals compress well, deflate all data arrays by default
+    f = nix.File.open(parts[0] + ".nix", nix.FileMode.Overwrite, compression=nix.Compression.DeflateNormal)
 
     # handle eeg data
     b = f.create_block(parts[0], "nix.recording.session")
 
     write_session_metadata(f, b, metadatafile)
 
+    # sampling interval shared by the eeg channels and the trigger signal
+    dt = sampling_interval(time)
+
     # TODO handle eeg offset
-    group_eeg = write_channel_data(b, data, time, sr, eeg_offset)
-    write_trigger_signal(b, trigger, time, group_eeg, eeg_offset)
+    group_eeg = write_channel_data(b, data, time, dt, sr, eeg_offset)
+    write_trigger_signal(b, trigger, time, dt, group_eeg, eeg_offset)
 
     # handle tobii data
     group_tobii = write_tobii_data(b, tobii_data, tobii_offset)
 
     # apply multi_tags
-    save_events(b, trigger, group_eeg, group_tobii)
+    save_events(b, trigger, sr, group_eeg, group_tobii)
 
     f.flush()
     f.close()
 
 
+# tobii properties that are recorded separately for each eye
+TOBII_EYE_PROPERTIES = ("pc", "pd", "gd")
+TOBII_PROPERTIES = TOBII_EYE_PROPERTIES + ("gp", "gp3", "gy", "ac", "pts", "vts", "evts", "dir")
+# sample fields stored for each property, in column order
+TOBII_FIELDS = {"pc": ("pc", "s"), "pd": ("pd", "s"), "gd": ("gd", "s"), "gp": ("gp", "l", "s"),
+                "gp3": ("gp3", "s"), "gy": ("gy", "s"), "ac": ("ac", "s"), "pts": ("pts", "pv", "s"),
+                "vts": ("vts", "s"), "evts": ("evts", "s"), "dir": ("dir", "sig", "s")}
+# timestamps and sync port flags stay integers, the measurements fit into single precision
+TOBII_DTYPES = {"pts": np.int64, "vts": np.int64, "evts": np.int64, "dir": np.uint8}
+NO_TOBII_DATA = (np.array([], dtype=np.int64), np.array([]))
+
+
+def columnar_tobii_data(tobii_data):
+    """
+    converts the tobii samples into one timestamp vector and data matrix per property,
+    sorting the samples by property in a single pass over the data
+    :param tobii_data: json fromatted signal form the tobii
+    :return: dict of (timestamps, data) sorted by timestamp, keyed by property
+     or by (property, eye) for per eye properties
+    """
+    buckets = {}
+    for e in tobii_data:
+        for prop in TOBII_PROPERTIES:
+            if prop in e:
+                key = (prop, e["eye"]) if prop in TOBII_EYE_PROPERTIES else prop
+                buckets.setdefault(key, []).append(e)
+
+    tobii_columns = {}
+    for (key, samples) in buckets.items():
+        prop = key[0] if isinstance(key, tuple) else key
+        tobii_columns[key] = sorted_tobii_columns(prop, samples)
+    return tobii_columns
+
+
+def sorted_tobii_columns(prop, samples):
+    """
+    builds the timestamp vector and the data matrix of one tobii property, both sorted by timestamp
+    :param prop: tobii property
+    :param samples: tobii samples of the property
+    :return: timestamps, data
+    """
+    ts = np.array([e["ts"] for e in samples], dtype=np.int64)
+    # stable sort keeps samples with equal timestamps in recording order
+    order = np.argsort(ts, kind="stable")
+
+    parts = []
+    for field in TOBII_FIELDS[prop]:
+        part = np.array([e[field] for e in samples])
+        if field == "dir":
+            part = part == "in"
+        parts.append(part.reshape(len(samples), -1))
+
+    dtype = TOBII_DTYPES.get(prop, np.float32)
+    combined = np.empty((len(samples), sum(part.shape[1] for part in parts)), dtype=dtype)
+    start = 0
+    for part in parts:
+        combined[:, start:start + part.shape[1]] = part[order]
+        start += part.shape[1]
+
+    return ts[order], combined
+
+
 def write_tobii_data(b, tobii_data, tobii_offset):
     group = b.create_group("tobii data", "nix.tobii")
+    tobii_columns = columnar_tobii_data(tobii_data)
 
-    da_left = write_tobii_pupil_center(b, tobii_data, tobii_offset, "left")
+    da_left = write_tobii_pupil_center(b, tobii_columns, tobii_offset, "left")
     group.data_arrays.append(da_left.id)
-    da_right = write_tobii_pupil_center(b, tobii_data, tobii_offset, "right")
+    da_right = write_tobii_pupil_center(b, tobii_columns, tobii_offset, "right")
     group.data_arrays.append(da_right.id)
 
-    da_left = write_tobii_pupil_diameter(b, tobii_data, tobii_offset, "left")
+    da_left = write_tobii_pupil_diameter(b, tobii_columns, tobii_offset, "left")
     group.data_arrays.append(da_left.id)
-    da_right = write_tobii_pupil_diameter(b, tobii_data, tobii_offset, "right")
+    da_right = write_tobii_pupil_diameter(b, tobii_columns, tobii_offset, "right")
     group.data_arrays.append(da_right.id)
 
-    da_left = write_tobii_gaze_dir(b, tobii_data, tobii_offset, "left")
+    da_left = write_tobii_gaze_dir(b, tobii_columns, tobii_offset, "left")
     group.data_arrays.append(da_left.id)
-    da_right = write_tobii_gaze_dir(b, tobii_data, tobii_offset, "right")
+    da_right = write_tobii_gaze_dir(b, tobii_columns, tobii_offset, "right")
     group.data_arrays.append(da_right.id)
 
-    write_tobii_gaze_pos(b, group, tobii_data, tobii_offset)
-    write_tobii_gaze_pos_3d(b, group, tobii_data, tobii_offset)
-    write_tobii_gyroscope(b, group, tobii_data, tobii_offset)
-    write_tobii_accelerometer(b, group, tobii_data, tobii_offset)
-    write_tobii_pipe_ts(b, group, tobii_data, tobii_offset)
-    write_tobii_video_ts(b, group, tobii_data, tobii_offset)
-    write_tobii_eye_video_ts(b, group, tobii_data, tobii_offset)
-    write_tobii_sync_port(b, group, tobii_data, tobii_offset)
+    write_tobii_gaze_pos(b, group, tobii_columns, tobii_offset)
+    write_tobii_gaze_pos_3d(b, group, tobii_columns, tobii_offset)
+    write_tobii_gyroscope(b, group, tobii_columns, tobii_offset)
+    write_tobii_accelerometer(b, group, tobii_columns, tobii_offset)
+    write_tobii_pipe_ts(b, group, tobii_columns, tobii_offset)
+    write_tobii_video_ts(b, group, tobii_columns, tobii_offset)
+    write_tobii_eye_video_ts(b, group, tobii_columns, tobii_offset)
+    write_tobii_sync_port(b, group, tobii_columns, tobii_offset)
 
     return group
 
 
-def write_tobii_sync_port(b, g, tobii_data, tobii_offset):
+def write_tobii_sync_port(b, g, tobii_columns, tobii_offset):
     prop = "dir"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        sig_dir = 0
-        if e[prop] == "in":
-            sig_dir = 1
-        combined.append([sig_dir, e["sig"], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("sync port", "nix.tobii.property", data=combined)
     da.label = "sync port"
@@ -272,17 +427,11 @@ def write_tobii_sync_port(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_eye_video_ts(b, g, tobii_data, tobii_offset):
+def write_tobii_eye_video_ts(b, g, tobii_columns, tobii_offset):
     prop = "evts"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        combined.append([e[prop], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("evts", "nix.tobii.property", data=combined)
     da.label = "eye video timestamp"
@@ -303,17 +452,11 @@ def write_tobii_eye_video_ts(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_video_ts(b, g, tobii_data, tobii_offset):
+def write_tobii_video_ts(b, g, tobii_columns, tobii_offset):
     prop = "vts"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        combined.append([e[prop], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("video timestamp", "nix.tobii.property", data=combined)
     da.label = "video timestamp"
@@ -334,17 +477,11 @@ def write_tobii_video_ts(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_pipe_ts(b, g, tobii_data, tobii_offset):
+def write_tobii_pipe_ts(b, g, tobii_columns, tobii_offset):
     prop = "pts"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        combined.append([e[prop], e["pv"], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("pipeline timestamp", "nix.tobii.property", data=combined)
     da.label = "pipeline timestamp"
@@ -365,18 +502,11 @@ def write_tobii_pipe_ts(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_accelerometer(b, g, tobii_data, tobii_offset):
+def write_tobii_accelerometer(b, g, tobii_columns, tobii_offset):
     prop = "ac"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        rotate = e[prop]
-        combined.append([rotate[0], rotate[1], rotate[2], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("MEMS accelerometer", "nix.tobii.property", data=combined)
     da.label = "rotation"
@@ -397,18 +527,11 @@ def write_tobii_accelerometer(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_gyroscope(b, g, tobii_data, tobii_offset):
+def write_tobii_gyroscope(b, g, tobii_columns, tobii_offset):
     prop = "gy"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        gy = e[prop]
-        combined.append([gy[0], gy[1], gy[2], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("MEMS gyroscope", "nix.tobii.property", data=combined)
     da.label = "rotation"
@@ -430,18 +553,11 @@ def write_tobii_gyroscope(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_gaze_pos_3d(b, g, tobii_data, tobii_offset):
+def write_tobii_gaze_pos_3d(b, g, tobii_columns, tobii_offset):
     prop = "gp3"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        gaze_pos = e[prop]
-        combined.append([gaze_pos[0], gaze_pos[1], gaze_pos[2], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("gaze position 3D", "nix.tobii.property", data=combined)
     da.label = "positions"
@@ -462,19 +578,11 @@ def write_tobii_gaze_pos_3d(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_gaze_pos(b, g, tobii_data, tobii_offset):
+def write_tobii_gaze_pos(b, g, tobii_columns, tobii_offset):
     prop = "gp"
-    filtered = filter(lambda x: x.__contains__(prop), tobii_data)
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        gaze_pos = e[prop]
-        # No description of the field "l" in the Tobii dev guide
-        combined.append([gaze_pos[0], gaze_pos[1], e["l"], e["s"]])
+    ts, combined = tobii_columns.get(prop, NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("gaze position", "nix.tobii.property", data=combined)
     da.label = "positions"
@@ -494,18 +602,11 @@ def write_tobii_gaze_pos(b, g, tobii_data, tobii_offset):
         g.data_arrays.append(da.id)
 
 
-def write_tobii_gaze_dir(b, tobii_data, tobii_offset, eye):
+def write_tobii_gaze_dir(b, tobii_columns, tobii_offset, eye):
     prop = "gd"
-    filtered = filter(lambda y: y["eye"] == eye, filter(lambda x: x.__contains__(prop), tobii_data))
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        coord = e[prop]
-        combined.append([coord[0], coord[1], coord[2], e["s"]])
+    ts, combined = tobii_columns.get((prop, eye), NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("gaze direction " + eye, "nix.tobii.property", data=combined)
     da.label = "gaze direction"
@@ -525,18 +626,11 @@ def write_tobii_gaze_dir(b, tobii_data, tobii_offset, eye):
     return da
 
 
-def write_tobii_pupil_center(b, tobii_data, tobii_offset, eye):
+def write_tobii_pupil_center(b, tobii_columns, tobii_offset, eye):
     prop = "pc"
-    filtered = filter(lambda y: y["eye"] == eye, filter(lambda x: x.__contains__(prop), tobii_data))
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply tobii offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        coord = e[prop]
-        combined.append([coord[0], coord[1], coord[2], e["s"]])
+    ts, combined = tobii_columns.get((prop, eye), NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("pupil center " + eye, "nix.tobii.property", data=combined)
     da.label = "coordinates"
@@ -558,17 +652,11 @@ def write_tobii_pupil_center(b, tobii_data, tobii_offset, eye):
     return da
 
 
-def write_tobii_pupil_diameter(b, tobii_data, tobii_offset, eye):
+def write_tobii_pupil_diameter(b, tobii_columns, tobii_offset, eye):
     prop = "pd"
-    filtered = filter(lambda y: y["eye"] == eye, filter(lambda x: x.__contains__(prop), tobii_data))
-    tobii_pc_data = sorted(filtered, key=operator.itemgetter("ts"))
-
-    ts = []
-    combined = []
-    for e in tobii_pc_data:
-        # apply offset to timestamp
-        ts.append(e["ts"] - tobii_offset)
-        combined.append([e[prop], e["s"]])
+    ts, combined = tobii_columns.get((prop, eye), NO_TOBII_DATA)
+    # apply offset to timestamp
+    ts = ts - tobii_offset
 
     da = b.create_data_array("pupil diameter " + eye, "nix.tobii.property", data=combined)
     da.label = "pupil diameter"
@@ -596,20 +684,24 @@ def load_data(filename):
     file_parts = name.split("_")
     pattern = "_".join(file_parts[:-1])
     files = glob.glob(os.path.join(folder, pattern + "*.mat"))
-    combined_data = None
+    chunks = []
+    nsamples = 0
     for f in files:
         print("INFO/EEG: Importing file '%s'" % f)
         data = scio.matlab.loadmat(f)
+        sr_key = [x for x in data.keys() if x.startswith('SR')][0]
+        sr = data[sr_key][0][0]
         y = np.squeeze(data["y"])
-        if combined_data is None:
-            combined_data = y
-        else:
-            last_time = combined_data[0, -1]
-            dt = np.mean(np.diff(combined_data[0, :]))
+        del data
+        if chunks:
+            # continue the time axis of the files loaded so far, which are not
+            # concatenated yet, so the interval is taken from their end points
+            last_time = chunks[-1][0, -1]
+            dt = mean_interval(chunks[0][0, 0], last_time, nsamples)
             y[0, :] = y[0, :] + last_time + dt
-            combined_data = np.hstack((combined_data, y))
-    sr_key = [x for x in data.keys() if x.startswith('SR')][0]
-    sr = data[sr_key][0][0]
+        chunks.append(y)
+        nsamples += y.shape[1]
+    combined_data = np.concatenate(chunks, axis=1)
     time = combined_data[0, :]
     trigger = combined_data[-1, :]
     data_eeg = combined_data[1:-1, :]  # fixed offset bug -2 -> -1
@@ -622,8 +714,8 @@ def load_tobii_data(filename):
     :param filename:
     :return: json python object
     """
-    fp = open(filename)
-    return [json.loads(e) for e in fp.readlines()]
+    with open(filename, "rb") as fp:
+        return [json.loads(e) for e in fp if e.strip()]
 
 
 def main():